@@ -1,6 +1,12 @@
 """LlamaIndex RAG app"""
 
+import asyncio
+import hashlib
+import queue
 import random
+import threading
+import time
+from concurrent.futures import Future
 from pathlib import Path
 
 import openai
@@ -8,14 +14,24 @@ import redis
 import streamlit as st
 import streamlit.components.v1 as components
 import tiktoken
+from cachetools import TTLCache
 from llama_index.core import (
     Settings,
     VectorStoreIndex,
 )
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.vector_stores import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 from llama_index.vector_stores.redis import RedisVectorStore
+from redis import asyncio as aioredis
 from redisvl.schema import IndexSchema
 from streamlit_pills import pills
 
@@ -54,28 +70,243 @@ if st.secrets.ENV == "production":
     )
 
 
-# Configure some settings
-openai.api_key = st.secrets.OPENAI_API_KEY
-Settings.embed_model = OpenAIEmbedding()
-Settings.llm = OpenAI(
-    model="gpt-4o-mini",
-    temperature=0.8,
-    system_prompt="""You are an expert on 
-    the Data Science Clinic and your 
-    job is to answer questions. 
-    Assume that all questions are related 
-    to the Data Science Clinic. Keep 
-    your answers based on 
+class BatchingOpenAIEmbedding(OpenAIEmbedding):
+    """OpenAI embedder that coalesces concurrent query embeddings.
+
+    Every chat turn embeds a single query. Sessions run in their own
+    threads, so queries arriving within `batch_window` seconds of each other
+    are collected by a worker thread and sent as one embeddings request.
+    """
+
+    batch_window: float = Field(
+        default=0.005,
+        description="Seconds to wait for more queries before sending a batch.",
+    )
+    max_query_batch: int = Field(
+        default=32,
+        description="Maximum number of queries sent in one request.",
+        gt=0,
+    )
+
+    _pending: queue.Queue = PrivateAttr(default_factory=queue.Queue)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
+    _worker_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        """Get class name."""
+        return "BatchingOpenAIEmbedding"
+
+    def _submit(self, query):
+        """Queue a query for the next batch and return its future."""
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run_batches, daemon=True
+                )
+                self._worker.start()
+        future = Future()
+        self._pending.put((query, future))
+        return future
+
+    def _next_batch(self):
+        """Block for one query, then gather more until the window closes."""
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_query_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self):
+        """Worker loop: embed each batch with a single API call."""
+        while True:
+            batch = self._next_batch()
+            # Identical queries (e.g. the same pill clicked in several
+            # sessions) are sent once and fanned back out
+            queries = list(dict.fromkeys(query for query, _ in batch))
+            try:
+                # Current OpenAI models use the same engine for queries and
+                # documents, so the batched text path is equivalent.
+                embeddings = self._get_text_embeddings(queries)
+            except Exception as e:
+                # Re-raised in each waiting session by Future.result()
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            by_query = dict(zip(queries, embeddings))
+            for query, future in batch:
+                future.set_result(by_query[query])
+
+    def _get_query_embedding(self, query):
+        """Embed a query through the shared batcher."""
+        return self._submit(query).result()
+
+    async def _aget_query_embedding(self, query):
+        """Embed a query through the shared batcher without blocking."""
+        return await asyncio.wrap_future(self._submit(query))
+
+
+class CachedOpenAIEmbedding(BatchingOpenAIEmbedding):
+    """Batching embedder with a TTL-bounded LRU cache of query vectors.
+
+    Pill questions and common questions repeat across sessions and reruns,
+    so their embeddings are served from memory instead of the API.
+    """
+
+    cache_size: int = Field(
+        default=2000, description="Maximum number of cached queries.", gt=0
+    )
+    cache_ttl: float = Field(
+        default=600, description="Seconds a cached query stays valid.", gt=0
+    )
+
+    _cache: TTLCache = PrivateAttr()
+    _pinned: dict = PrivateAttr(default_factory=dict)
+    _cache_lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(self, **kwargs):
+        """Init params."""
+        super().__init__(**kwargs)
+        self._cache = TTLCache(maxsize=self.cache_size, ttl=self.cache_ttl)
+
+    @classmethod
+    def class_name(cls):
+        """Get class name."""
+        return "CachedOpenAIEmbedding"
+
+    @staticmethod
+    def _cache_key(query):
+        """Normalize a query so trivially different strings share a key."""
+        return query.strip().lower()
+
+    def _lookup(self, query):
+        """Return the cached embedding for a query, or None."""
+        key = self._cache_key(query)
+        with self._cache_lock:
+            embedding = self._pinned.get(key) or self._cache.get(key)
+            if embedding is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return embedding
+
+    def _store(self, query, embedding):
+        """Cache the embedding for a query."""
+        with self._cache_lock:
+            self._cache[self._cache_key(query)] = embedding
+
+    def cache_info(self):
+        """Report hit, miss and size counters for the query cache.
+
+        Returns:
+            dict: Cache statistics
+        """
+        with self._cache_lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "size": len(self._cache),
+            }
+
+    def clear_cache(self):
+        """Drop all cached and preloaded query embeddings."""
+        with self._cache_lock:
+            self._cache.clear()
+            self._pinned.clear()
+
+    def preload(self, queries):
+        """Embed known queries in one request and keep them without expiry.
+
+        Args:
+            queries (list): Query strings to embed
+        """
+        embeddings = self._get_text_embeddings(queries)
+        with self._cache_lock:
+            for query, embedding in zip(queries, embeddings):
+                self._pinned[self._cache_key(query)] = embedding
+
+    def _get_query_embedding(self, query):
+        """Embed a query, serving repeats from the cache."""
+        embedding = self._lookup(query)
+        if embedding is None:
+            embedding = super()._get_query_embedding(query)
+            self._store(query, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query):
+        """Embed a query without blocking, serving repeats from the cache."""
+        embedding = self._lookup(query)
+        if embedding is None:
+            embedding = await super()._aget_query_embedding(query)
+            self._store(query, embedding)
+        return embedding
+
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer():
+    """Load the tiktoken BPE tables once per process."""
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+@st.cache_resource(show_spinner=False)
+def get_embed_model():
+    """Build the query embedder once per process and share it."""
+    return CachedOpenAIEmbedding()
+
+
+# Collapsed to a single line, whitespace is sent as tokens on every call
+system_prompt = " ".join(
+    """You are an expert on
+    the Data Science Clinic and your
+    job is to answer questions.
+    Assume that all questions are related
+    to the Data Science Clinic. Keep
+    your answers based on
     facts – do not hallucinate features.
-    """,
+    """.split()
 )
 
+
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """Build the chat LLM once per process and share it."""
+    return OpenAI(
+        model="gpt-4o-mini",
+        temperature=0.8,
+        system_prompt=system_prompt,
+    )
+
+
+# Configure some settings
+openai.api_key = st.secrets.OPENAI_API_KEY
+Settings.embed_model = get_embed_model()
+Settings.llm = get_llm()
+
 Settings.text_splitter = SentenceSplitter(
     chunk_size=512,
     chunk_overlap=50,
-    tokenizer=tiktoken.encoding_for_model("gpt-3.5-turbo").encode,
+    tokenizer=get_tokenizer().encode,
 )
 
+# Predefined questions related to the Data Science Clinic
+pill_questions = [
+    "What is the Data Science Clinic?",
+    "What are the main features of the Clinic?",
+    "How do I apply to join the Clinic?",
+    "What is the expected workload?",
+    "How do I get involved in Clinic?",
+    "What are the coding standards?",
+    "How do I get an A in the class?",
+]
+
 # Initialize the chat messages history
 if "messages" not in st.session_state:
     st.session_state.messages = [
@@ -85,12 +316,13 @@ if "messages" not in st.session_state:
         }
     ]
 
+# Pill questions already answered in this session
+if "displayed_pill_questions" not in st.session_state:
+    st.session_state.displayed_pill_questions = set()
 
-@st.cache_resource(show_spinner=False)
-def load_data():
-    """Load index from redis vectorstore."""
-    embed_model = Settings.embed_model
 
+def get_redis_url():
+    """Build the redis url from secrets."""
     redis_host = st.secrets.REDIS_HOST
     redis_port = st.secrets.REDIS_PORT
     redis_url = f"redis://{redis_host}:{redis_port}"
@@ -102,43 +334,200 @@ def load_data():
             f"redis://{redis_user}:{redis_pwd}@{redis_host}:{redis_port}"
         )
 
-    redis_client = redis.Redis.from_url(redis_url)
+    return redis_url
+
+
+@st.cache_resource(show_spinner=False)
+def get_redis_pool():
+    """Create one keep-alive connection pool shared by all sessions."""
+    # Blocking, so callers queue for a free connection once all 32 are in use
+    # instead of failing with "Too many connections"
+    return redis.BlockingConnectionPool.from_url(
+        get_redis_url(),
+        max_connections=32,
+        timeout=10,
+        socket_keepalive=True,
+        health_check_interval=30,
+        # Vector payloads are binary, skip decoding replies
+        decode_responses=False,
+    )
+
+
+def index_fingerprint():
+    """Hash the index schema file and embedding model name.
+
+    Returns:
+        str: Hex digest identifying the index configuration
+    """
+    schema_bytes = (config_dir / "index_schema.yaml").read_bytes()
+    model_name = Settings.embed_model.model_name.encode()
+    return hashlib.sha256(schema_bytes + model_name).hexdigest()
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_data(fingerprint):
+    """Load index from redis vectorstore.
+
+    Args:
+        fingerprint (str): Index configuration hash. The index is built once
+            per process and only rebuilt when this changes.
+
+    Returns:
+        VectorStoreIndex: Index over the redis vectorstore
+    """
+    embed_model = Settings.embed_model
+
+    redis_client = redis.Redis(connection_pool=get_redis_pool())
+    # Used by async retrieval on the background event loop
+    redis_client_async = aioredis.Redis(
+        connection_pool=aioredis.BlockingConnectionPool.from_url(
+            get_redis_url(),
+            max_connections=32,
+            timeout=10,
+            socket_keepalive=True,
+            health_check_interval=30,
+        )
+    )
 
     vector_store = RedisVectorStore(
         redis_client=redis_client,
+        redis_client_async=redis_client_async,
         schema=IndexSchema.from_yaml(config_dir / "index_schema.yaml"),
         overwrite=False,
     )
     index = VectorStoreIndex.from_vector_store(
         vector_store=vector_store, embed_model=embed_model
     )
+    # Cached query vectors belong to the previous index
+    embed_model.clear_cache()
+    # Embed every pill question in a single batch up front
+    embed_model.preload(pill_questions)
 
     return index
 
 
-index = load_data()
+index = load_data(index_fingerprint())
+
+
+def section_filters():
+    """Restrict retrieval to the sections listed in SEARCH_SECTIONS, if set.
+
+    Redis applies the tag filter before HNSW scoring, so fewer candidates
+    are compared and returned.
+
+    Returns:
+        MetadataFilters: Section filter, or None to search everything
+    """
+    sections = st.secrets.get("SEARCH_SECTIONS")
+    if not sections:
+        return None
+    return MetadataFilters(
+        filters=[
+            MetadataFilter(
+                key="section", operator=FilterOperator.IN, value=list(sections)
+            )
+        ]
+    )
+
+
+def make_chat_engine(memory=None):
+    """Build a streaming chat engine over the index.
+
+    Context mode retrieves with the raw message and answers in a single LLM
+    call, rather than condensing the question with an extra call first.
+
+    Args:
+        memory (ChatMemoryBuffer, optional): Conversation memory. Defaults to
+            a fresh buffer.
+
+    Returns:
+        BaseChatEngine: Chat engine
+    """
+    return index.as_chat_engine(
+        chat_mode="context",
+        similarity_top_k=3,
+        filters=section_filters(),
+        memory=memory,
+        verbose=True,
+        streaming=True,
+    )
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def canned_answer(question):
+    """Answer a pill question once and share the answer across sessions.
+
+    A fresh engine is used so the answer does not depend on the history of
+    whichever session asked first.
+
+    Args:
+        question (str): Pill question
+
+    Returns:
+        str: Assistant response
+    """
+    return "".join(make_chat_engine().stream_chat(question).response_gen)
+
+
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Start one asyncio event loop in a daemon thread for all sessions."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def stream_response(chat_engine, prompt):
+    """Stream a chat response generated on the background event loop.
+
+    Retrieval and the LLM call run as a coroutine, so the script thread
+    only waits on a queue of tokens.
+
+    Args:
+        chat_engine (BaseChatEngine): Session chat engine
+        prompt (str): User message
+
+    Yields:
+        str: Response tokens
+    """
+    tokens = queue.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            response = await chat_engine.astream_chat(prompt)
+            async for token in response.async_response_gen():
+                tokens.put(token)
+        finally:
+            tokens.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    try:
+        while (token := tokens.get()) is not done:
+            yield token
+    finally:
+        # Streamlit closes the generator when the script is stopped mid-stream,
+        # don't let the reply keep running and land in the chat memory
+        if not future.done():
+            future.cancel()
+    # Re-raise anything that failed while producing the response
+    future.result()
+
 
 # Initialize the chat engine
 if "chat_engine" not in st.session_state.keys():
-    st.session_state.chat_engine = index.as_chat_engine(
-        chat_mode="condense_question", verbose=True, streaming=True
+    st.session_state.chat_memory = ChatMemoryBuffer.from_defaults(
+        token_limit=3000
+    )
+    st.session_state.chat_engine = make_chat_engine(
+        st.session_state.chat_memory
     )
 
 
 def select_questions():
     """Return a list of predefined questions for the pills."""
-    # Predefined questions related to the Data Science Clinic
-    full_questions = [
-        "What is the Data Science Clinic?",
-        "What are the main features of the Clinic?",
-        "How do I apply to join the Clinic?",
-        "What is the expected workload?",
-        "How do I get involved in Clinic?",
-        "What are the coding standards?",
-        "How do I get an A in the class?",
-    ]
     # Randomly select 3 questions from the full list
-    return random.sample(full_questions, 3)
+    return random.sample(pill_questions, 3)
 
 
 if "selected_pills" not in st.session_state.keys():
@@ -159,35 +548,58 @@ if prompt := st.chat_input("Ask a question"):
     st.session_state.messages.append({"role": "user", "content": prompt})
 
 
+def render_message(message):
+    """Write a chat message to the UI.
+
+    Args:
+        message (dict): Message with "role" and "content" keys
+    """
+    avatar = avatar_url if message["role"] == "assistant" else None
+    with st.chat_message(message["role"], avatar=avatar):
+        st.markdown(message["content"])
+
+
 # Write message history to UI
 for message in st.session_state.messages:
-    # If message is from assistant, write it to the UI as a chat message
-    if message["role"] == "assistant":
-        with st.chat_message(message["role"], avatar=avatar_url):
-            st.write(message["content"])
-    else:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+    render_message(message)
 
 # To avoid duplicated display of answered pill questions each rerun
-if selected and selected not in st.session_state.get(
-    "displayed_pill_questions", set()
-):
-    st.session_state.setdefault("displayed_pill_questions", set()).add(selected)
+if selected and selected not in st.session_state.displayed_pill_questions:
+    st.session_state.displayed_pill_questions.add(selected)
 
-    with st.chat_message("user"):
-        st.write(selected)
-        user_message = {"role": "user", "content": selected}
-        st.session_state.messages.append(user_message)
+    user_message = {"role": "user", "content": selected}
+    st.session_state.messages.append(user_message)
+    render_message(user_message)
 
-    st.session_state["chat_engine"].stream_chat(selected)
+    # Pill answers are cached, so no embedding, retrieval or LLM call here
+    with st.chat_message("assistant", avatar=avatar_url):
+        answer = canned_answer(selected)
+        st.write(answer)
+        message = {"role": "assistant", "content": answer}
+        st.session_state.messages.append(message)
+
+    # Keep the session's engine aware of the exchange for follow-ups
+    st.session_state.chat_memory.put(
+        ChatMessage(role=MessageRole.USER, content=selected)
+    )
+    st.session_state.chat_memory.put(
+        ChatMessage(role=MessageRole.ASSISTANT, content=answer)
+    )
 
 # If last message is not from assistant, generate a new response
 if st.session_state.messages[-1]["role"] != "assistant":
     with st.chat_message("assistant", avatar=avatar_url):
-        response_stream = st.session_state.chat_engine.stream_chat(prompt)
-        st.write_stream(response_stream.response_gen)
+        response_stream = stream_response(st.session_state.chat_engine, prompt)
+        # write_stream returns the text it wrote, so the answer is only
+        # accumulated once
+        response = st.write_stream(response_stream)
 
         # Add response to message history
-        message = {"role": "assistant", "content": response_stream.response}
+        message = {"role": "assistant", "content": response}
         st.session_state.messages.append(message)
+
+# Show query embedding cache stats outside production
+if st.secrets.ENV != "production":
+    with st.sidebar:
+        st.caption("Query embedding cache")
+        st.json(Settings.embed_model.cache_info())
@@ -1,8 +1,13 @@
 """Ingestion pipeline for Clinic Chat."""
 
+import asyncio
+import functools
+import hashlib
 import json
 import os
+import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import dotenv
@@ -10,6 +15,7 @@ import git
 import htmltabletomd
 import openai
 import redis
+import tiktoken
 from llama_index.core import (
     Document,
     Settings,
@@ -24,24 +30,57 @@ from llama_index.core.readers.base import BaseReader
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.readers.google import GoogleDriveReader
 from llama_index.storage.docstore.redis import RedisDocumentStore
+from llama_index.storage.kvstore.redis import RedisKVStore
 from llama_index.vector_stores.redis import RedisVectorStore
+from redis import asyncio as aioredis
 from redisvl.schema import IndexSchema
 
 dotenv.load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+URL_PREFIX = "https://clinic.ds.uchicago.edu/"
+
+# Google Drive docs ingested alongside the repo, needs service_account_key.json
+GOOGLE_FILE_IDS = [
+    # "1XtyqoFgvX2aUhKBBjA0Oba8DbvZsuf3sdQeFH1Nt1TA",
+    # "1E5wyLk4vXHeg_c0WmxvVYlKI9wnTj7P4pktkH7csLn8",
+    # "1ovkawtyIw7Itfx1Kj1uw0wnKyrMNBpdldNCFsTd2fcw",
+]
+
+# Everything up to and including the first "/data/" in a file path
+DATA_PREFIX_RE = re.compile(r"^.*?/data/")
+# Metadata only needed as a Redis tag, kept out of embeddings and prompts
+INDEX_ONLY_METADATA = ["section"]
+
 
 def download_repo(repo_url, to_path):
-    """Clones a repo to a path.
+    """Shallow clones a repo to a path, or updates an existing clone.
 
     Args:
         repo_url (str): GitHub URL
         to_path (Path): Path to clone to
     """
-    if Path.exists(Path(to_path)):
-        shutil.rmtree(to_path)
-    git.Repo.clone_from(repo_url, to_path)
+    if (Path(to_path) / ".git").is_dir():
+        # Only fetch the latest commit instead of re-cloning
+        repo = git.Repo(to_path)
+        repo.remotes.origin.fetch(depth=1)
+        repo.git.reset("--hard", "FETCH_HEAD")
+    else:
+        # Not a git checkout, clear it out before cloning
+        if Path.exists(Path(to_path)):
+            shutil.rmtree(to_path)
+        # Partial clone: blobs are only downloaded for checked-out files
+        repo = git.Repo.clone_from(
+            repo_url,
+            to_path,
+            depth=1,
+            single_branch=True,
+            filter="blob:none",
+            sparse=True,
+        )
+        # Only check out the file types the reader ingests
+        repo.git.sparse_checkout("set", "--no-cone", "*.md", "*.pdf")
 
 
 def get_meta(file_path):
@@ -52,22 +91,25 @@ def get_meta(file_path):
     Returns:
         dict: Metadata
     """
-    url_prefix = "https://clinic.ds.uchicago.edu/"
-
-    # Find the position of "data/" in the path and replace everything before it
-    data_index = file_path.find("/data/")
-    if data_index != -1:
-        # Replace everything up to and including "/data/" with the URL prefix
-        file_path = (
-            url_prefix + file_path[data_index + 6 :]
-        )  # +6 to skip "/data/"
+    section = None
+
+    # Replace everything up to and including "data/" with the URL prefix
+    rel_path, found = DATA_PREFIX_RE.subn("", file_path, count=1)
+    if found:
+        # Top-level folder (or file) in the repo, used as a search filter
+        section = rel_path.split("/", 1)[0].split(".", 1)[0]
+        file_path = URL_PREFIX + rel_path
     else:
         print(f"Warning: 'data/' not found in file path: {file_path}")
 
+    # Only swap the extension, ".md" may also appear mid-path
     if file_path.endswith(".md"):
-        file_path = file_path.replace(".md", ".html")
+        file_path = file_path[: -len(".md")] + ".html"
 
-    return {"link": file_path}
+    meta = {"link": file_path}
+    if section:
+        meta["section"] = section
+    return meta
 
 
 def load_key(file_path):
@@ -91,10 +133,23 @@ def load_google_data(file_ids):
     Returns:
         list: list of Documents
     """
+    if not file_ids:
+        return []
+
     file_dir = Path(__file__).parent.parent
     service_account_key = load_key(file_dir / "service_account_key.json")
-    loader = GoogleDriveReader(service_account_key=service_account_key)
-    docs = loader.load_data(file_ids=file_ids)
+
+    def load_file(file_id):
+        # GoogleDriveReader stores the credentials it builds on the instance,
+        # so each download gets its own reader rather than sharing one
+        loader = GoogleDriveReader(service_account_key=service_account_key)
+        return loader.load_data(file_ids=[file_id])
+
+    # Fetch files concurrently rather than one HTTPS download at a time
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = executor.map(load_file, file_ids)
+        docs = [doc for file_docs in results for doc in file_docs]
+
     for doc in docs:
         doc.id_ = doc.metadata.get("file path", "none")
     return docs
@@ -113,34 +168,94 @@ class OverrideReader(BaseReader):
         Returns:
             list: List of Document objects.
         """
-        if str(file).endswith("/projects.md"):
-            with Path.open(file) as f:
-                text = f.read()
-                text = htmltabletomd.convert_table(
-                    text, content_conversion_ind=True
-                )
-        elif "/admin/" in str(file):
-            # skip admin files
-            return ""
-        else:
-            with Path.open(file) as f:
-                text = f.read()
+        text = Path(file).read_text(encoding="utf-8")
+        # Only pay for the HTML table parse when there is a table
+        if str(file).endswith("/projects.md") and "<table" in text:
+            text = htmltabletomd.convert_table(
+                text, content_conversion_ind=True
+            )
 
         return [Document(text=text, extra_info=extra_info or {})]
 
 
+def load_repo_data(repo_url, repo_path):
+    """Downloads the docs repo and loads its markdown and PDF files.
+
+    Args:
+        repo_url (str): GitHub URL
+        repo_path (Path): Path to clone to
+
+    Returns:
+        list: list of Documents
+    """
+    download_repo(repo_url, repo_path)
+
+    reader = SimpleDirectoryReader(
+        input_dir=repo_path,
+        required_exts=[".md", ".pdf"],
+        recursive=True,
+        # Admin files are never opened
+        exclude=["admin/**"],
+        file_metadata=get_meta,
+        file_extractor={".md": OverrideReader()},
+        # Stable ids let the docstore skip unchanged files on reruns
+        filename_as_id=True,
+    )
+    # Parse files in worker processes, leaving one core for the parent
+    docs = reader.load_data(
+        num_workers=max(1, (os.cpu_count() or 1) - 1), show_progress=False
+    )
+    # Key docs by their path in the repo, wherever it is checked out
+    for doc in docs:
+        doc.id_ = doc.id_.removeprefix(f"{repo_path}/")
+        doc.excluded_embed_metadata_keys.extend(INDEX_ONLY_METADATA)
+        doc.excluded_llm_metadata_keys.extend(INDEX_ONLY_METADATA)
+    return docs
+
+
+def drop_docstore_namespaces(redis_client, pattern, keep=None):
+    """Deletes docstore namespaces from redis.
+
+    Args:
+        redis_client (redis.Redis): Redis client
+        pattern (str): Glob matching the namespaces to delete
+        keep (str, optional): Namespace to leave in place. Defaults to None.
+    """
+    keep_prefix = f"{keep}/".encode() if keep else None
+    keys = [
+        key
+        for key in redis_client.scan_iter(match=f"{pattern}/*")
+        if keep_prefix is None or not key.startswith(keep_prefix)
+    ]
+    if keys:
+        redis_client.delete(*keys)
+
+
 def main():
     """Main function"""
     parent_dir = Path(__file__).parent.parent
     config_dir = parent_dir / "config"
 
     # changing the global default
-    embed_model = OpenAIEmbedding()
+    # 256 chunks of up to 1024 tokens stays under the API's per-request cap
+    # num_workers batches are sent concurrently by the async pipeline
+    embed_model = OpenAIEmbedding(embed_batch_size=256, num_workers=8)
     Settings.embed_model = embed_model
 
     # Chunk size
     Settings.chunk_size = 1024
     Settings.chunk_overlap = 20
+    # The tokenizer of the OpenAI embedding model, named so the index version
+    # can include it
+    splitter_encoding = "cl100k_base"
+    Settings.text_splitter = SentenceSplitter(
+        chunk_size=Settings.chunk_size,
+        chunk_overlap=Settings.chunk_overlap,
+        tokenizer=functools.partial(
+            tiktoken.get_encoding(splitter_encoding).encode,
+            allowed_special="all",
+        ),
+    )
 
     # Define and save schema
     custom_schema = IndexSchema.from_dict(
@@ -152,12 +267,18 @@ def main():
                 {"type": "tag", "name": "id"},
                 {"type": "tag", "name": "doc_id"},
                 {"type": "text", "name": "text"},
+                {"type": "tag", "name": "section"},
                 {
                     "type": "vector",
                     "name": "vector",
                     "attrs": {
                         "dims": 1536,
                         "algorithm": "hnsw",
+                        "m": 32,
+                        "ef_construction": 256,
+                        "ef_runtime": 128,
+                        # half the bytes per vector of float32
+                        "datatype": "float16",
                         "distance_metric": "cosine",
                     },
                 },
@@ -166,31 +287,15 @@ def main():
     )
     custom_schema.to_yaml(config_dir / "index_schema.yaml")
 
-    # Download git repo
+    # Clone and read the repo while the Drive files download
     repo_url = "https://github.com/dsi-clinic/the-clinic.git"
     repo_path = parent_dir / "data"
-    download_repo(repo_url, repo_path)
-
-    # Load the local docs
-    reader = SimpleDirectoryReader(
-        input_dir=repo_path,
-        required_exts=[".md", ".pdf"],
-        recursive=True,
-        file_metadata=get_meta,
-        file_extractor={".md": OverrideReader()},
-    )
-    local_docs = reader.load_data()
-
-    # google_docs = load_google_data(
-    #     file_ids=[
-    #         "1XtyqoFgvX2aUhKBBjA0Oba8DbvZsuf3sdQeFH1Nt1TA",
-    #         "1E5wyLk4vXHeg_c0WmxvVYlKI9wnTj7P4pktkH7csLn8",
-    #         "1ovkawtyIw7Itfx1Kj1uw0wnKyrMNBpdldNCFsTd2fcw",
-    #     ]
-    # )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        local_docs = executor.submit(load_repo_data, repo_url, repo_path)
+        google_docs = executor.submit(load_google_data, GOOGLE_FILE_IDS)
 
-    # Combine local and google docs
-    docs = local_docs  # + google_docs
+        # Combine local and google docs
+        docs = local_docs.result() + google_docs.result()
 
     # Set up Redis connection and vectorstore
     redis_host = os.getenv("REDIS_HOST")
@@ -204,25 +309,71 @@ def main():
             f"redis://{redis_user}:{redis_pwd}@{redis_host}:{redis_port}"
         )
 
-    redis_client = redis.Redis.from_url(redis_url)
-    vector_store = RedisVectorStore(
-        redis_client=redis_client, overwrite=True, schema=custom_schema
+    # One pool per client type, shared by the vector store and the docstore.
+    # Blocking, so callers wait for a free connection at the cap
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        redis_url, max_connections=32, timeout=10
     )
-    docstore = RedisDocumentStore.from_redis_client(
-        redis_client=redis_client, namespace="document_store"
+    redis_client = redis.Redis(connection_pool=redis_pool)
+    # The async pipeline reads and writes through the async clients
+    redis_client_async = aioredis.Redis(
+        connection_pool=aioredis.BlockingConnectionPool.from_url(
+            redis_url, max_connections=32, timeout=10
+        )
+    )
+
+    # Document hashes are tracked per index version: changing the schema,
+    # embedding model, chunking or embedded metadata starts from an empty
+    # docstore and re-embeds everything
+    index_version = hashlib.sha256(
+        (config_dir / "index_schema.yaml").read_bytes()
+        + embed_model.model_name.encode()
+        + f"{Settings.chunk_size}:{Settings.chunk_overlap}".encode()
+        + splitter_encoding.encode()
+        + ",".join(INDEX_ONLY_METADATA).encode()
+    ).hexdigest()[:12]
+    namespace = f"document_store_{index_version}"
+    docstore = RedisDocumentStore(
+        RedisKVStore(
+            redis_client=redis_client, async_redis_client=redis_client_async
+        ),
+        namespace=namespace,
+        # Pipeline docstore writes instead of one round trip per node
+        batch_size=500,
+    )
+    # Only rebuild the index when nothing has been ingested for this version,
+    # otherwise update it in place
+    rebuild = not docstore.get_all_document_hashes()
+    if rebuild:
+        # Docstores of older versions describe an index that is being replaced
+        drop_docstore_namespaces(
+            redis_client, "document_store*", keep=namespace
+        )
+    vector_store = RedisVectorStore(
+        redis_client=redis_client,
+        redis_client_async=redis_client_async,
+        overwrite=rebuild,
+        schema=custom_schema,
     )
 
     # Create and run ingestion pipeline
     pipeline = IngestionPipeline(
         transformations=[
-            SentenceSplitter(),
+            Settings.text_splitter,
             embed_model,
         ],
         docstore=docstore,
         vector_store=vector_store,
-        docstore_strategy=DocstoreStrategy.UPSERTS,
+        # Skip unchanged docs, replace changed ones, drop deleted ones
+        docstore_strategy=DocstoreStrategy.UPSERTS_AND_DELETE,
     )
-    pipeline.run(documents=docs)
+    try:
+        asyncio.run(pipeline.arun(documents=docs, show_progress=True))
+    except BaseException:
+        # Docs are recorded in the docstore before their vectors are written,
+        # forget this run so the next one re-ingests instead of skipping them
+        drop_docstore_namespaces(redis_client, namespace)
+        raise
 
 
 if __name__ == "__main__":